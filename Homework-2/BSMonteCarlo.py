@@ -10,14 +10,23 @@
 
 __author__ = "oshashkov"
 
+import math
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from numpy import exp,sqrt,maximum,mean,std
-from numpy.random import randn
-from scipy.stats import sem
+from numpy import sqrt
+from numba import config, njit, vectorize, float32, float64
+from scipy.stats import norm
+from scipy.stats.qmc import Sobol
 
 # these are standard tenors for US Treasury Yield Curve as of 10/1/2020
 RATE_CURVE_TENORS = [1/12,2/12,3/12,6/12,1,2,3,5,7,10,20,30]
 
+# below this number of values the running statistics are computed 
+# in the calling thread
+PARALLEL_STATS_MIN_SIZE = 1 << 20
+
 def InterpolateRateCurve(curve,T,tenors=None):
     """ Interpolates the value of Yield Rate based on the provided rate curve
    
@@ -45,7 +54,206 @@ def InterpolateRateCurve(curve,T,tenors=None):
     return np.interp(T,tenors,curve)
 
 
-def BSMonteCarlo(S0, K, T, sigma, checkpoints, rateCurve, samples=None):
+def make_rate_interp(curve,tenors=None):
+    """ Builds a rate curve interpolator once, so that repeated lookups
+    (Greeks, calibration loops, many fixing times) do not repeat the checks
+    and conversions of InterpolateRateCurve
+   
+    Parameters
+    ----------
+    curve : array of floats
+         represents rate curve. The length of curve and tenors must be the same
+    tenors : array of floats, optional
+        Tenors for Yield Rate curve . The default is None.
+
+    Returns
+    -------
+    interp : function
+        interp(T) returns the interpolated rate for a float or an array of T
+    """
+    if curve is None:
+        raise ValueError("Yield curve can not be None")    
+        
+    if tenors is None:
+        tenors = RATE_CURVE_TENORS #assume it's constant
+    tenors = np.asarray(tenors, dtype=np.float64)
+    curve = np.asarray(curve, dtype=np.float64)
+    if len(tenors) != len(curve):
+        raise ValueError("Yield curve and tenors are of different lengths")
+    return lambda T: np.interp(T,tenors,curve)
+
+
+@vectorize([float32(float32,float32,float32,float32,float32,float32),
+            float64(float64,float64,float64,float64,float64,float64)],
+           target='parallel', cache=True, fastmath=True)
+def _bs_payoff(z, S0, K, drift, vol, disc):
+    """ Discounted call payoff for a single standard normal sample z,
+    evaluated in one fused pass instead of a chain of numpy temporaries.
+    fastmath lets numba vectorize math.exp with SVML when available.
+    drift = (r-0.5*sigma^2)*T, vol = sigma*sqrt(T) and disc = exp(-r*T)
+    are computed once by the caller
+    """
+    p = S0*math.exp(drift+vol*z)-K
+    return disc*p if p > 0.0 else 0.0
+
+
+@vectorize([float32(float32,float32,float32),
+            float64(float64,float64,float64)],
+           target='parallel', cache=True, fastmath=True)
+def _bs_growth(z, drift, vol):
+    """ Growth factor S_T/S0 = exp(drift+vol*z) of a single standard normal
+    sample z, with drift = (r-0.5*sigma^2)*T and vol = sigma*sqrt(T) 
+    computed once by the caller. It does not depend on the contract, so it
+    is evaluated once per sample for all strikes and spots. fastmath lets
+    numba vectorize math.exp with SVML when available
+    """
+    return math.exp(drift+vol*z)
+
+
+@vectorize([float32(float32,float32,float32,float32),
+            float64(float64,float64,float64,float64)],
+           target='parallel', cache=True, fastmath=True)
+def _bs_call(g, S0, K, disc):
+    """ Discounted call payoff for a growth factor g, disc = exp(-r*T),
+    evaluated in one fused pass instead of a chain of numpy temporaries
+    """
+    p = S0*g-K
+    return disc*p if p > 0.0 else 0.0
+
+
+@njit(cache=True, boundscheck=False)
+def _interleave_antithetic(buf, half):
+    """ Turns buf[:half] = z into buf = [z0,-z0,z1,-z1,...] in place.
+    Going from the last pair down never overwrites an unread z
+    """
+    M = buf.shape[0]
+    for i in range(half-1, -1, -1):
+        z = buf[i]
+        buf[2*i] = z
+        if 2*i+1 < M:
+            buf[2*i+1] = -z
+
+
+@njit(nogil=True, fastmath=True, cache=True, boundscheck=False)
+def _welford(vals, lo, hi):
+    """ Single pass (Welford) mean and sum of squared deviations of 
+    vals[lo:hi]. Releases the GIL so that segments run in parallel threads
+    """
+    m = 0.0
+    m2 = 0.0
+    for i in range(lo, hi):
+        x = np.float64(vals[i])
+        d = x-m
+        m += d/(i-lo+1)
+        m2 += d*(x-m)
+    return m, m2
+
+
+def RunningStats(vals, checkpoints, workers=None):
+    """ Computes running statistics of Monte Carlo values at checkpoints
+
+    Parameters
+    ----------
+    vals : numpy array
+        values to average, either one sample per element or one row of
+        samples per contract
+    checkpoints : ordered list
+        is an ordered list of integer sample counts at which to return
+        the running mean, standard deviation, and estimated error
+    workers : int, optional
+        number of threads. The values are cut into segments at the 
+        checkpoints and into workers equal chunks, the segments are reduced
+        in parallel and then merged pairwise in order. The default is None,
+        i.e. os.cpu_count(), or a single thread for small inputs
+
+    Returns
+    -------
+    means, stds, st_errs : numpy arrays of float64
+        running mean, standard deviation and standard error at each 
+        checkpoint, with one row per contract if vals is 2-D
+    """
+    vals = np.asarray(vals)
+    rows = vals[None,:] if vals.ndim == 1 else vals
+    n = np.asarray(checkpoints, dtype=np.int64)
+    if (n.ndim != 1 or len(n) == 0 or n[0] < 1 or (np.diff(n) < 0).any()
+            or n[-1] > rows.shape[1]):
+        raise ValueError("checkpoints must be a non-decreasing list of "
+                         "sample counts in [1,{0}]".format(rows.shape[1]))
+    if workers is None:
+        workers = 1 if rows[:,:n[-1]].size < PARALLEL_STATS_MIN_SIZE \
+                    else os.cpu_count() or 1
+                    
+    edges = np.unique(np.concatenate(([0], n, 
+            np.linspace(0, n[-1], workers+1).astype(np.int64))))
+    segments = [(row, lo, hi) for row in rows
+                for lo, hi in zip(edges[:-1], edges[1:])]
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            partials = list(executor.map(lambda seg: _welford(*seg), segments))
+    else:
+        partials = [_welford(*seg) for seg in segments]
+    
+    # merge the segments in order (Chan et al. pairwise update) and record
+    # the statistics whenever a checkpoint is reached
+    means = np.full((rows.shape[0],len(n)), np.nan)
+    m2s = np.full_like(means, np.nan)
+    partials = iter(partials)
+    for j in range(rows.shape[0]):
+        count, m, m2 = 0, 0.0, 0.0
+        k = 0
+        for lo, hi in zip(edges[:-1], edges[1:]):
+            mb, m2b = next(partials)
+            nb = hi-lo
+            total = count+nb
+            d = mb-m
+            m += d*nb/total
+            m2 += m2b+d*d*count*nb/total
+            count = total
+            while k < len(n) and n[k] == count:
+                means[j,k] = m
+                m2s[j,k] = m2
+                k += 1
+    
+    stds = sqrt(m2s/n) # same as np.std (ddof=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        st_errs = stds/sqrt(n-1) # same as scipy.stats.sem
+    if vals.ndim == 1:
+        return means[0], stds[0], st_errs[0]
+    return means, stds, st_errs
+
+
+def _validate(S0, K, T, sigma):
+    """ Checks the contract parameters of BSMonteCarlo with a single
+    vectorized test, the offending parameter is only looked for on failure
+    """
+    params = np.concatenate((np.ravel(S0), np.ravel(K), (T, sigma)))
+    if (params > 0).all(): # NaN compares False so it fails the test as well
+        return
+    
+    # test parameters for NaN
+    if np.isnan(K).any():
+        raise ValueError("Strike price can not be NaN")
+    if np.isnan(S0).any():
+        raise  ValueError("Underlying price can not be NaN")
+    if np.isnan(T):
+        raise  ValueError("Time to expiration can not be NaN")
+    if np.isnan(sigma):
+        raise  ValueError("Volatility can not be NaN")
+    
+    # check values of input parameters
+    if (S0 <= 0).any():
+        raise ValueError("Underlying price can not be zero or negative")
+    if (K <= 0).any():
+        raise ValueError("Strike price can not be zero or negative")
+    if T <= 0:
+        raise ValueError("Expiration time can not be zero or negative")
+    if sigma <= 0:
+        raise ValueError("Volatility can not be zero or negative")
+
+
+def BSMonteCarlo(S0, K, T, sigma, checkpoints, rateCurve, samples=None,
+                 antithetic=True, qmc=False, dtype=np.float32, rng=None,
+                 work=None, seed=None):
     """ Estimates value of vanilla european-exercise options usinf Monte Carlo
     method in Black-Scholes-Merton model
     
@@ -53,10 +261,13 @@ def BSMonteCarlo(S0, K, T, sigma, checkpoints, rateCurve, samples=None):
 
     Parameters
     ----------
-    S0 : float
+    S0 : float or array of floats
         current price of underlying asset
-    K : float
-        option strike price
+    K : float or array of floats
+        option strike price. S0 and K are broadcast against each other and
+        every (S0, K) contract is priced from the same samples. The 
+        exponential exp((r-0.5*sigma^2)*T+sigma*sqrt(T)*z) is evaluated
+        once per sample and shared by all contracts, e.g. a strike ladder
     T : float
         time to expiration expressed in years (1 month = 1/12 -> T = 0.08(3))
     sigma : float
@@ -65,11 +276,42 @@ def BSMonteCarlo(S0, K, T, sigma, checkpoints, rateCurve, samples=None):
     checkpoints : ordered list
         is an ordered list of integer sample counts at which to return
         the running mean, standard deviation, and estimated error
-    rateCurve : numpy array
-        is an InterestRateCurve stored as a numpy array
+    rateCurve : numpy array or function
+        is an InterestRateCurve stored as a numpy array, or an interpolator
+        built by make_rate_interp
     samples : numpy array of floats, optional
         is a numpy array of uniform random samples to use. 
         The default is None
+    antithetic : bool, optional
+        only used when samples is None: draws M/2 normal samples z and
+        pairs each with -z (antithetic variates), which lowers the variance
+        of the estimate for a monotone payoff at half the RNG cost.
+        Caller-supplied samples are used as is. The default is True
+    qmc : bool, optional
+        only used when samples is None: draws scrambled Sobol' points and
+        maps them to normal samples with the inverse normal CDF
+        (quasi-Monte Carlo). For a smooth integrand like the Black-Scholes
+        payoff the error decreases close to O(1/M) instead of O(1/sqrt(M)),
+        so far fewer samples are needed for the same accuracy. StdErrs are
+        still computed as for independent samples and overstate the error.
+        Takes precedence over antithetic. The default is False
+    dtype : numpy float type, optional
+        precision of the samples and payoffs. float32 halves the memory
+        traffic of the payoff kernel; the running statistics are always
+        accumulated in float64. The default is np.float32
+    rng : numpy.random.Generator, optional
+        generator used to draw the samples when samples is None.
+        The default is None, i.e. numpy.random.default_rng(seed)
+    work : numpy array of dtype, optional
+        preallocated buffer of at least M elements used in place of a new
+        allocation when samples is None. The samples are generated into it
+        and then overwritten with the payoffs, so one buffer can be reused
+        across repeated calls (Greeks by bumping, calibration). 
+        The default is None
+    seed : int or numpy.random.BitGenerator, optional
+        seed of the generator created when rng is None: an int seeds the
+        default PCG64, a bit generator such as numpy.random.Philox(seed) is
+        used as is. The default is None (fresh entropy)
 
     Returns
     -------
@@ -78,61 +320,124 @@ def BSMonteCarlo(S0, K, T, sigma, checkpoints, rateCurve, samples=None):
             'StdDevs': , # The running standard deviation at each checkpoint
             'StdErrs': , # The running standard error at each checkpoint
             }
+    with one value per checkpoint for scalar S0 and K, otherwise 'TV' is
+    an array with one value per contract and the running statistics are
+    arrays of shape (contracts, checkpoints)
     """
     
-    # test parameters for None and NaN
-    if np.isnan(K):
-        raise ValueError("Strike price can not be NaN")
-    if np.isnan(S0):
-        raise  ValueError("Underlying price can not be NaN")
-    if np.isnan(T):
-        raise  ValueError("Time to expiration can not be NaN")
-    if np.isnan(sigma):
-        raise  ValueError("Volatility can not be NaN")
+    S0 = np.asarray(S0, dtype=np.float64)
+    K = np.asarray(K, dtype=np.float64)
+    _validate(S0, K, T, sigma)
     if rateCurve is None:
         raise ValueError("Yield curve can not be None")
     if checkpoints is None:
         raise ValueError("checkpoints can not be None")        
     
-    # check values of input parameters
-    if S0 <= 0:
-        raise ValueError("Underlying price can not be zero or negative")
-    if K <= 0:
-        raise ValueError("Strike price can not be zero or negative")
-    if T <= 0:
-        raise ValueError("Expiration time can not be zero or negative")
-    if sigma <= 0:
-        raise ValueError("Volatility can not be zero or negative")
+    return _bsmc_core(S0, K, T, sigma, checkpoints, rateCurve, samples,
+                      antithetic, qmc, dtype, rng, work, seed)
+
+
+def _bsmc_core(S0, K, T, sigma, checkpoints, rateCurve, samples=None,
+               antithetic=True, qmc=False, dtype=np.float32, rng=None,
+               work=None, seed=None):
+    """ BSMonteCarlo without the validation of the contract parameters, 
+    for trusted inner loops (calibration, Greeks) that reprice many times
+    with parameters already checked by the caller. Same parameters and
+    results as BSMonteCarlo
+    """
+    
+    S0 = np.asarray(S0, dtype=np.float64)
+    K = np.asarray(K, dtype=np.float64)
+    if S0.ndim > 1 or K.ndim > 1:
+        raise ValueError("S0 and K must be floats or 1-D arrays")
+    batched = S0.ndim > 0 or K.ndim > 0
     
     M = checkpoints[-1]
     
+    if samples is not None:
+        samples = np.asarray(samples)
+        if samples.ndim == 2 and samples.shape[1] == 1:
+            samples = samples[:,0] # a column of samples, e.g. randn(M,1)
+        elif samples.ndim != 1:
+            raise ValueError('samples must be a 1-D array or a single column')
+    
     # check for samples and generate them if needed
     if samples is None:
-        samples = randn(M)
+        if work is None:
+            samples = np.empty(M, dtype=dtype)
+        elif len(work) < M or work.dtype != dtype:
+            raise ValueError('work must hold at least {0} samples of {1}'
+                             .format(M, np.dtype(dtype)))
+        else:
+            samples = work[:M]
+        if rng is None:
+            rng = np.random.default_rng(seed)
+        
+        if qmc:
+            # exactly M points: the checkpoints use prefixes of the sequence
+            # anyway, so its full balance (at powers of 2 only) is not 
+            # kept at them, while the scrambled points still lower the error
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore', message='The balance',
+                                        category=UserWarning)
+                u = Sobol(d=1, scramble=True, seed=rng).random(M).ravel()
+            samples[:] = norm.ppf(np.clip(u, 1e-12, 1-1e-12, out=u))
+        elif antithetic:
+            # interleave z and -z so that every even-length prefix 
+            # (checkpoint) is antithetically balanced
+            half = (M+1)//2
+            rng.standard_normal(dtype=dtype, out=samples[:half])
+            _interleave_antithetic(samples, half)
+        else:
+            rng.standard_normal(dtype=dtype, out=samples)
+        # the generated samples are not needed after the payoff evaluation
+        vals = samples
     elif len(samples) < M:
         raise ValueError('Not enough samples: {0}'.format(len(samples)))
+    else:
+        vals = None
+    samples = samples[:M].astype(dtype, copy=False)
     
     # find the value of "r" for given T using rate curve
-    r = InterpolateRateCurve(rateCurve,T)
+    if callable(rateCurve):
+        r = rateCurve(T)
+    else:
+        r = InterpolateRateCurve(rateCurve,T)
     if r is None:
         raise ValueError('Unable to obtain r')
     
-    running_means = []
-    running_stds = []
-    running_st_errs = []
-    vals = []
-       
-    for i in range(len(checkpoints)):
-        # compute option values using MC method
-        vals = exp(-r*T) * maximum(0,S0*exp((r-0.5*sigma**2)*T 
-                + sigma*sqrt(T)*samples[:checkpoints[i]])-K)
-        #compute running means, stds and errors
-        running_means.append(mean(vals))
-        running_stds.append(std(vals))
-        running_st_errs.append(sem(vals))
+    # compute option values once for all samples and contracts using MC 
+    # method, contracts along axis 0. Parameters are cast to dtype so that
+    # the matching kernel loop is selected
+    cast = np.dtype(dtype).type
+    S0, K = np.broadcast_arrays(np.atleast_1d(S0), np.atleast_1d(K))
+    drift = (r-0.5*sigma*sigma)*T
+    vol = sigma*sqrt(T)
+    disc = math.exp(-r*T)
+    # a single contract is priced in one fused pass. For several contracts
+    # the exponential is computed once per sample and only the payoff per
+    # contract. Generated samples (vals) are overwritten in place
+    if len(S0) == 1:
+        vals = _bs_payoff(samples[:M], cast(S0[0]), cast(K[0]), cast(drift),
+                          cast(vol), cast(disc), out=vals)[None,:]
+    else:
+        growth = _bs_growth(samples[:M], cast(drift), cast(vol), out=vals)
+        vals = _bs_call(growth[None,:], S0[:,None].astype(dtype),
+                        K[:,None].astype(dtype), cast(disc))
+    
+    # compute running means, stds and errors at checkpoints in one pass
+    running_means, running_stds, running_st_errs = RunningStats(vals,
+                                                                checkpoints)
+
+    final_values = running_means[:,-1]
+    if not batched:
+        final_values = final_values[0]
+        running_means = running_means[0]
+        running_stds = running_stds[0]
+        running_st_errs = running_st_errs[0]
     
     results = {}
-    results['TV'] = running_means[-1]# The final value ( i.e. mean at checkpoints[-1] )
+    results['TV'] = final_values# The final value ( i.e. mean at checkpoints[-1] )
     results['Means'] = running_means# The running mean at each checkpoint
     results['StdDevs'] = running_stds# The running standard deviation at each checkpoint
     results['StdErrs'] = running_st_errs# The running standard error at each checkpoint
@@ -154,13 +459,17 @@ if __name__ == '__main__':
     print('Parameters:\nS0 = {0}, K = {1}, T = {2}, Sigma = {3}\n'.format(
         S0,K,T,sigma))
     
+    # the fastmath kernels call the SIMD exp of Intel SVML when numba finds
+    # it (pip/conda package icc_rt), otherwise the scalar libm exp
+    print('Numba uses SVML: {0}\n'.format(config.USING_SVML))
+    
     r = InterpolateRateCurve(rate_curve,T)
     print('Calculated r = {0}\n'.format(r))
       
     checkpoints = 10**np.arange(2,8)
     print('Checkpoints:\n{0}\n'.format(checkpoints))
     
-    samples = randn(checkpoints[-1])
+    samples = np.random.default_rng().standard_normal(checkpoints[-1])
     str_expected_results = '''
     # matlab: [Call, Put] = blsprice(100,110,0.145,2.5,0.4)
     # Call = 35.4805
@@ -11,15 +11,17 @@
 __author__ = "oshashkov"
 
 import numpy as np
-from numpy import exp,maximum,mean,std
+from numpy import exp,maximum
 from numpy.random import randn 
-from scipy.stats import sem
 import matplotlib.pyplot as plt
-from BSMonteCarlo import InterpolateRateCurve
-from MCStockPrices import MCStockPrices
+from BSMonteCarlo import InterpolateRateCurve, RunningStats
+from MCStockPrices import _integrator_constants, _simulate
 
+# number of samples simulated per block (256 KB of float32, i.e. L2 sized)
+BLOCK_SIZE = 65536
 
-def MCOptionPrices(S0, K, T, rateCurve, sigma, t, checkpoints, samples, integrator):
+def MCOptionPrices(S0, K, T, rateCurve, sigma, t, checkpoints, samples, integrator,
+                   seed=20000, rng=None):
     """ Makes Approximation of the prices of European Options
 
     Parameters
@@ -30,8 +32,9 @@ def MCOptionPrices(S0, K, T, rateCurve, sigma, t, checkpoints, samples, integrat
         the strike price
     T : float
         the expiration date of the European option
-    rateCurve : numpy array
-        an InterestRateCurve stored as a numpy array
+    rateCurve : numpy array or function
+        an InterestRateCurve stored as a numpy array, or an interpolator
+        built by make_rate_interp
     sigma : float
         the constant volatility
     t : array
@@ -41,9 +44,9 @@ def MCOptionPrices(S0, K, T, rateCurve, sigma, t, checkpoints, samples, integrat
         at which to return the running mean, standard deviation, and
         estimated error
     samples : array
-        an array of uniform random samples to use. The length of samples 
-        should be N x M where N is the number of fixing times and 
-        M is the number of paths
+        an array of normal random samples to use of shape M x N where
+        N is the number of fixing times and M is the number of paths, i.e.
+        one path per row (C-contiguous)
     integrator : string
         controls how the samples are generated according
         to the following value list:
@@ -51,6 +54,13 @@ def MCOptionPrices(S0, K, T, rateCurve, sigma, t, checkpoints, samples, integrat
         the Black-Scholes SDE step-by-step
         - 'euler', to use Euler-method integration of the BlackScholes SDE
         - 'milstein', to use Milstein-method integration of the BlackScholes SDE
+    seed : int or numpy.random.BitGenerator, optional
+        seed of the generator used when samples is None: an int seeds the
+        default PCG64, a bit generator such as numpy.random.Philox(seed) is
+        used as is. The default is 20000
+    rng : numpy.random.Generator, optional
+        generator used when samples is None, takes precedence over seed.
+        The default is None
 
     Returns
     -------
@@ -85,34 +95,46 @@ def MCOptionPrices(S0, K, T, rateCurve, sigma, t, checkpoints, samples, integrat
         raise ValueError("Strike price can not be zero or negative")
     if T <= 0:
         raise ValueError("Expiration time can not be zero or negative")
-    if np.shape(t)[0] != np.shape(samples)[1]:
-        raise ValueError("samples and t are of incompatible shapes")        
         
     # check for samples and generate them if needed
     if samples is None:
-        np.random.seed(20000)
-        samples = randn(checkpoints[-1],len(t))
+        if rng is None:
+            rng = np.random.default_rng(seed)
+        samples = rng.standard_normal((checkpoints[-1],len(t)),
+                                      dtype=np.float32)
     elif np.shape(samples)[0] < checkpoints[-1]:
         raise ValueError('Not enough samples: {0}'.format(np.shape(samples)[0]))
+    if np.shape(t)[0] != np.shape(samples)[1]:
+        raise ValueError("samples and t are of incompatible shapes")        
     
     # find the value of "r" for given T using rate curve
-    r = InterpolateRateCurve(rateCurve,T)
+    if callable(rateCurve):
+        r = rateCurve(T)
+    else:
+        r = InterpolateRateCurve(rateCurve,T)
     if r is None:
         raise ValueError('Unable to obtain r')
     
-    running_means = []
-    running_stds = []
-    running_st_errs = []
-    vals = []
-       
-    for i in range(len(checkpoints)):
-        # compute option values using MC method
-        stock_prices = MCStockPrices(S0, sigma, rate_curve, fixing_times, samples[:checkpoints[i],:], integrator)
-        vals = exp(-r*T) * maximum(0,stock_prices[:,-1]-K)
-        #compute running means, stds and errors
-        running_means.append(mean(vals))
-        running_stds.append(std(vals))
-        running_st_errs.append(sem(vals))
+    # simulate the paths in blocks of rows: the same L2 sized buffer receives
+    # every block and only the terminal prices are kept. The kernel 
+    # constants are computed once for all blocks
+    consts = _integrator_constants(sigma, rateCurve, t)
+    M = checkpoints[-1]
+    block = max(1, BLOCK_SIZE//len(t))
+    out = np.empty((min(block,M),len(t)), dtype=np.float32)
+    terminal_prices = np.empty(M)
+    for j0 in range(0, M, block):
+        j1 = min(j0+block, M)
+        stock_prices = _simulate(float(S0), consts, samples[j0:j1,:],
+                                 integrator, out=out)
+        terminal_prices[j0:j1] = stock_prices[:,-1]
+    
+    # compute option values once for all paths using MC method
+    vals = exp(-r*T) * maximum(0,terminal_prices-K)
+    
+    # compute running means, stds and errors at checkpoints in one pass
+    running_means, running_stds, running_st_errs = RunningStats(vals,
+                                                                checkpoints)
     
     results = {}
     results['TV'] = running_means[-1]# The final value ( i.e. mean at checkpoints[-1] )
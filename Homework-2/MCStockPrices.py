@@ -11,13 +11,77 @@
 
 __author__ = "oshashkov"
 
+import logging
+import math
 import numpy as np
-from numpy import exp,sqrt,cumsum,cumprod
 from numpy.random import randn 
+from numba import njit, prange
 import matplotlib.pyplot as plt
 from BSMonteCarlo import InterpolateRateCurve
 
-def MCStockPrices(S0, sigma, rateCurve, t, samples, integrator):
+log = logging.getLogger(__name__)
+
+
+# Integrator kernels: samples and out are M x N (one path per row), paths are
+# independent and are integrated in parallel, each path in a single pass
+# without temporary arrays. The running value is a float64 scalar whatever
+# the dtype of samples and out
+
+@njit(parallel=True, fastmath=True, cache=True, boundscheck=False)
+def _standard(S0, drift_dt, vol_dt, samples, out):
+    M, N = samples.shape
+    for j in prange(M):
+        acc = 0.0
+        for i in range(N):
+            acc += drift_dt+vol_dt*samples[j,i]
+            out[j,i] = S0*math.exp(acc)
+    return out
+
+
+@njit(parallel=True, fastmath=True, cache=True, boundscheck=False)
+def _euler(S0, growth_dt, vol_dt, samples, out):
+    M, N = samples.shape
+    for j in prange(M):
+        acc = S0
+        for i in range(N):
+            acc *= growth_dt+vol_dt*samples[j,i]
+            out[j,i] = acc
+    return out
+
+
+@njit(parallel=True, fastmath=True, cache=True, boundscheck=False)
+def _milstein(S0, growth_dt, vol_dt, m_coef, samples, out):
+    # the step factors are multiplied into a float64 accumulator as in
+    # _euler. Only a path whose accumulator would leave the normal float64
+    # range continues as a (signed) sum of logarithms
+    M, N = samples.shape
+    for j in prange(M):
+        acc = S0
+        in_log_space = False
+        log_acc = 0.0
+        sign = 1.0
+        for i in range(N):
+            z = samples[j,i]
+            factor = growth_dt+vol_dt*z+m_coef*(z*z-1.0)
+            if not in_log_space:
+                next_acc = acc*factor
+                size = abs(next_acc)
+                if size < 1e300 and (size > 1e-300 or next_acc == 0.0):
+                    acc = next_acc
+                    out[j,i] = acc
+                    continue
+                in_log_space = True
+                log_acc = math.log(abs(acc))
+                sign = 1.0 if acc > 0.0 else -1.0
+            log_acc += math.log(abs(factor))
+            if factor < 0.0:
+                sign = -sign
+            out[j,i] = sign*math.exp(log_acc)
+    return out
+
+
+def MCStockPrices(S0, sigma, rateCurve, t, samples, integrator,
+                  dtype=np.float32, out=None):
     """ Simulates stock prices using requested integrator method
     
     Parameters
@@ -26,14 +90,16 @@ def MCStockPrices(S0, sigma, rateCurve, t, samples, integrator):
         the stock prices at time t0
     sigma : float
         the constant volatility
-    rateCurve : numpy array
-        an InterestRateCurve stored as a numpy array
+    rateCurve : numpy array or function
+        an InterestRateCurve stored as a numpy array, or an interpolator
+        built by make_rate_interp
     t : array
         an array of fixing times ti; i = 1...N to simulate to
     samples : array
-        an array of uniform random samples to use. The length of samples
-        should be N x M where N is the number of fixing times
-        and M is the number of paths
+        an array of normal random samples to use of shape M x N where
+        N is the number of fixing times and M is the number of paths, i.e.
+        one path per row. C-contiguous layout keeps each path contiguous
+        in memory for the integration along axis 1
     integrator : string
         controls how the samples are generated according
         to the following value list:
@@ -41,6 +107,14 @@ def MCStockPrices(S0, sigma, rateCurve, t, samples, integrator):
         the Black-Scholes SDE step-by-step
         - 'euler', to use Euler-method integration of the BlackScholes SDE
         - 'milstein', to use Milstein-method integration of the BlackScholes SDE
+    dtype : numpy float type, optional
+        precision of the samples and of the returned prices. float32 halves
+        the memory traffic; each path is still accumulated in float64.
+        The default is np.float32
+    out : numpy array of dtype, optional
+        preallocated C-contiguous buffer with at least M rows and N columns
+        to write the prices into, so repeated calls can reuse one
+        allocation. The default is None
 
     Returns
     -------
@@ -66,23 +140,61 @@ def MCStockPrices(S0, sigma, rateCurve, t, samples, integrator):
     if np.shape(t)[0] != np.shape(samples)[1]:
         raise ValueError("samples and t are of incompatible shapes")
     
+    consts = _integrator_constants(sigma, rateCurve, t)
+    return _simulate(float(S0), consts, samples, integrator, dtype, out)
+
+
+def _integrator_constants(sigma, rateCurve, t):
+    """ Scalar constants of the integrator kernels as Python floats, so that
+    they are passed to the kernels as float64 registers. Callers simulating
+    many blocks of paths compute them once and reuse them with _simulate
+    
+    Returns
+    -------
+    tuple (drift_dt, vol_dt, growth_dt, m_coef)
+    """
     # calculate rate for each step t
-    rates = InterpolateRateCurve(rateCurve,t)
-    r = rates[-1] # has to be static according to Professor and TA explanation
+    if callable(rateCurve):
+        rates = rateCurve(t)
+    else:
+        rates = InterpolateRateCurve(rateCurve,t)
+    if rates is None:
+        raise ValueError('Unable to obtain r')
+    r = float(rates[-1]) # has to be static according to Professor and TA explanation
 
-    dt = t[0] # assumption: timesteps are all of the same size
-   
-    stock_prices = np.empty(0)
+    dt = float(t[0]) # assumption: timesteps are all of the same size
+    sigma = float(sigma)
+    log.debug("r=%r dt=%r", r, dt)
+    
+    drift_dt = (r-0.5*sigma*sigma)*dt
+    vol_dt = sigma*math.sqrt(dt)
+    growth_dt = 1.0+r*dt
+    m_coef = 0.5*sigma*sigma*dt # stoch coeff is sigma*S: 0.5*sigma*sigma*dt
+    return drift_dt, vol_dt, growth_dt, m_coef
+
+
+def _simulate(S0, consts, samples, integrator, dtype=np.float32, out=None):
+    """ Runs the integrator kernel with precomputed constants, without the
+    parameter checks of MCStockPrices
+    """
+    drift_dt, vol_dt, growth_dt, m_coef = consts
+    
+    samples = np.ascontiguousarray(samples, dtype=dtype)
+    if out is None:
+        out = np.empty_like(samples)
+    elif (out.dtype != samples.dtype or out.shape[1:] != samples.shape[1:]
+          or out.shape[0] < samples.shape[0]):
+        raise ValueError("out is of incompatible shape or dtype")
+    else:
+        out = out[:samples.shape[0]]
 
     # switch over integrator parameters and simulate price
     if integrator == 'standard':
-        stock_prices = S0*exp(cumsum((r-0.5*sigma**2)*dt+sigma*sqrt(dt)*samples,axis=1))
+        stock_prices = _standard(S0, drift_dt, vol_dt, samples, out)
     elif integrator == 'euler':
-        stock_prices = S0*cumprod(1+r*dt+sigma*sqrt(dt)*samples,axis=1)
+        stock_prices = _euler(S0, growth_dt, vol_dt, samples, out)
     elif integrator == 'milstein':
-        delStochCoeffdelAsset = sigma # stoch coeff is sigma*S
-        stock_prices = S0*cumprod(1+r*dt+sigma*sqrt(dt)*samples
-                +0.5*sigma*delStochCoeffdelAsset*(samples**2*dt-dt),axis=1)
+        stock_prices = _milstein(S0, growth_dt, vol_dt, m_coef, samples, out)
     else:
         raise ValueError('Unknown integrator method: {0}'.format(integrator))
     
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# test_RunningStats.py - Checks of running statistics and antithetic samples
+# used by BSMonteCarlo
+# MSF 526
+# Illinois Institute of Technology
+# Homework 2
+# Author: Oleksandr Shashkov
+# ID: A20229995
+# Email: oshashko@hawk.iit.edu
+
+__author__ = "oshashkov"
+
+import numpy as np
+from scipy.stats import sem
+from BSMonteCarlo import RunningStats, _interleave_antithetic
+
+def expected_stats(vals, checkpoints):
+    """ Running statistics computed independently at each checkpoint """
+    means = [np.mean(vals[:n]) for n in checkpoints]
+    stds = [np.std(vals[:n]) for n in checkpoints]
+    st_errs = [sem(vals[:n]) if n > 1 else np.nan for n in checkpoints]
+    return np.array(means), np.array(stds), np.array(st_errs)
+
+def check(name, ok):
+    print('{0}: {1}'.format(name, 'passed' if ok else 'FAILED'))
+    return ok
+
+all_ok = True
+
+print('***** Test case 1: RunningStats against np.std and scipy.stats.sem\n\
+n=1, repeated checkpoints, checkpoints cutting worker chunks\n')
+
+vals = np.random.default_rng(20000).standard_normal(10007)*5.0+3.0
+checkpoints = [1, 2, 2, 10, 1000, 2500, 2500, 5003, 10007]
+print('Checkpoints:\n{0}\n'.format(checkpoints))
+
+for workers in [1, 4]:
+    for dtype in [np.float64, np.float32]:
+        x = vals.astype(dtype)
+        expected = expected_stats(x.astype(np.float64), checkpoints)
+        result = RunningStats(x, checkpoints, workers=workers)
+        ok = all(np.allclose(r, e, rtol=1e-10, atol=0.0, equal_nan=True)
+                 for r, e in zip(result, expected))
+        ok = ok and np.isnan(result[2][0]) # n=1 has no standard error
+        all_ok &= check('workers={0}, {1}'.format(
+            workers, np.dtype(dtype).name), ok)
+print('')
+
+print('***** Test case 2: RunningStats with one row per contract\n')
+
+rows = np.vstack([vals, 2.0*vals-1.0])
+checkpoints = [3, 700, 10007]
+for workers in [1, 4]:
+    means, stds, st_errs = RunningStats(rows, checkpoints, workers=workers)
+    ok = True
+    for j in range(rows.shape[0]):
+        expected = expected_stats(rows[j], checkpoints)
+        ok = ok and all(np.allclose(r, e, rtol=1e-10, atol=0.0)
+                        for r, e in zip((means[j], stds[j], st_errs[j]),
+                                        expected))
+    all_ok &= check('workers={0}, 2 rows'.format(workers), ok)
+print('')
+
+print('***** Test case 3: Handling incorrect checkpoints\n\
+Expected results: Gracefully handled exception for each case\n')
+
+for checkpoints in [[0, 5], [5, 3], [10008], []]:
+    try:
+        RunningStats(vals, checkpoints)
+        all_ok &= check('checkpoints={0}'.format(checkpoints), False)
+    except ValueError as error:
+        print('checkpoints={0}: RunningStats returned ValueError: {1}'.format(
+            checkpoints, error))
+print('')
+
+print('***** Test case 4: Antithetic samples [z0,-z0,z1,-z1,...]\n')
+
+for M in [8, 9, 1]:
+    half = (M+1)//2
+    z = np.arange(1.0, half+1.0)
+    buf = np.zeros(M)
+    buf[:half] = z
+    _interleave_antithetic(buf, half)
+    expected = np.empty(2*half)
+    expected[0::2] = z
+    expected[1::2] = -z
+    print('M = {0}: {1}'.format(M, buf))
+    all_ok &= check('M={0}'.format(M), np.array_equal(buf, expected[:M]))
+print('')
+
+print('All checks passed' if all_ok else 'Some checks FAILED')